@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import ezodf
 from mininterface import run
+from tqdm import tqdm
 from tyro.conf import DisallowNone, FlagCreatePairsOff
 
 from ._lib.env import Env
-from ._lib.find_file_recursive import filename_cache
-from ._lib.process import process_sheet
+from ._lib.find_file_recursive import cache, filename_cache
+from ._lib.process import (
+    CONVERT_WORKERS,
+    page_template,
+    process_sheet,
+    process_sheet_by_name,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -30,9 +37,41 @@ def main():
     else:
         suffix = True
 
+    if m.env.output:
+        # fail fast on a broken template, before processing the sheets
+        page_template(m.env.slidershow.template, m.env.slidershow.url)
+
     with filename_cache(m.env.filename_autosearch_cache):
-        for sheet in sheets:
-            process_sheet(m, suffix, sheet)
+        if m.env.output and len(sheets) > 1:
+            # Every sheet goes to its own file, process them in parallel.
+            # Each worker converts one media at a time, so limit the workers if converting.
+            max_workers = CONVERT_WORKERS if m.env.convert.enable else None
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(
+                        process_sheet_by_name, m.env, suffix, sheet.name, cache
+                    )
+                    for sheet in sheets
+                ]
+                try:
+                    results = [
+                        f.result()
+                        for f in tqdm(
+                            as_completed(futures), total=len(futures), desc="Sheets"
+                        )
+                    ]
+                except BaseException:
+                    executor.shutdown(cancel_futures=True)
+                    raise
+            # Apply the removals first so that they do not discard an entry another worker found.
+            for _, removed in results:
+                for name in removed:
+                    cache.pop(name, None)
+            for added, _ in results:
+                cache.update(added)
+        else:
+            for sheet in sheets:
+                process_sheet(m.env, suffix, sheet)
 
 
 if __name__ == "__main__":
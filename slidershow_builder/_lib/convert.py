@@ -1,6 +1,10 @@
+from collections import defaultdict
 from dataclasses import dataclass
+from functools import lru_cache
 import logging
+import os
 from pathlib import Path
+from threading import Lock
 from typing import Callable
 
 from .convert_tools import ffmpeg_video, file_meta_key, heic_to_jpg, is_hevc
@@ -9,6 +13,21 @@ IMAGE_SUFFIXES = ".jpg", ".jpeg", ".jxl", ".png", ".gif", ".avif", ".webp", ".he
 
 logger = logging.getLogger(__name__)
 
+# Media are converted from multiple threads, do not convert the same file twice at once.
+# (Sheet worker processes may still convert the same file concurrently, each into its own
+# temporary file that atomically replaces the cached one.)
+# Kept outside of Convert as locks cannot be pickled.
+_locks: defaultdict[Path, Lock] = defaultdict(Lock)
+_locks_guard = Lock()
+# Cached files known to exist, no need to stat them again.
+_existing: set[Path] = set()
+
+
+@lru_cache(maxsize=4096)
+def _is_hevc_cached(path: str, mtime: float, size: int) -> bool:
+    """Run ffprobe once per file version."""
+    return is_hevc(Path(path))
+
 
 @dataclass
 class Convert:
@@ -36,15 +55,38 @@ class Convert:
         if self.enable and not self.cache_dir.exists():
             self.cache_dir.mkdir(parents=True, exist_ok=True)
 
-    def get_cached_path(self, p: Path, suffix: str):
+    def get_cached_path(self, p: Path, suffix: str, stat: os.stat_result | None = None):
         """suffix with dot"""
-        return self.cache_dir / (p.name + f".{file_meta_key(p)}{suffix}")
+        return self.cache_dir / (p.name + f".{file_meta_key(p, stat)}{suffix}")
 
-    def get_converted(self, path: Path, suffix: str, method: Callable):
-        cached = self.get_cached_path(path, suffix)
-        exists = cached.exists()
-        if self.autogenerate and not exists:
-            method(path, cached)
+    def get_converted(
+        self,
+        path: Path,
+        suffix: str,
+        method: Callable,
+        stat: os.stat_result | None = None,
+    ):
+        cached = self.get_cached_path(path, suffix, stat)
+        with _locks_guard:
+            lock = _locks[cached]
+        with lock:
+            exists = cached in _existing or cached.exists()
+            if self.autogenerate and not exists:
+                # Convert to a temporary file and move it in place at once, so that
+                # an interrupted conversion never looks like a cached file.
+                # (The converters guess the format from the suffix, keep it last.)
+                tmp = cached.with_name(
+                    f"{cached.stem}.{os.getpid()}.part{cached.suffix}"
+                )
+                try:
+                    method(path, tmp)
+                    if tmp.exists():
+                        os.replace(tmp, cached)
+                finally:
+                    tmp.unlink(missing_ok=True)
+                exists = cached.exists()
+            if exists:
+                _existing.add(cached)
         if not self.autogenerate and not exists:
             return path
         return cached
@@ -52,18 +94,25 @@ class Convert:
     def run(self, path: Path):
         suff = path.suffix.lower()
         if self.enable:
-            if not path.exists():
+            try:
+                # A single stat per media, its version keys both the cache and the HEVC check.
+                stat = path.stat()
+            except OSError:
                 logger.warning(f"Filename {path} does not exist")
             else:
                 match suff:
                     case ".heic":
                         if self.heic:
-                            path = self.get_converted(path, ".jpg", heic_to_jpg)
+                            path = self.get_converted(path, ".jpg", heic_to_jpg, stat)
                     case ".hevc":
                         if self.hevc:
-                            path = self.get_converted(path, ".mp4", ffmpeg_video)
+                            path = self.get_converted(path, ".mp4", ffmpeg_video, stat)
                     case ".mp4":
-                        if self.hevc and self.hevc_in_mp4 and is_hevc(path):
-                            path = self.get_converted(path, ".mp4", ffmpeg_video)
+                        if (
+                            self.hevc
+                            and self.hevc_in_mp4
+                            and _is_hevc_cached(str(path), stat.st_mtime, stat.st_size)
+                        ):
+                            path = self.get_converted(path, ".mp4", ffmpeg_video, stat)
 
         return path
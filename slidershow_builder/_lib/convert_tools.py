@@ -1,4 +1,5 @@
 import logging
+import os
 import shlex
 import subprocess
 from hashlib import blake2b
@@ -8,8 +9,9 @@ from subprocess import run
 logger = logging.getLogger(__name__)
 
 
-def file_meta_key(p: Path):
-    stat = p.stat()
+def file_meta_key(p: Path, stat: os.stat_result | None = None):
+    """Short hash telling the versions of the file apart. Pass the `stat` if already known."""
+    stat = stat or p.stat()
     meta = f"{p.name}|{stat.st_size}|{int(stat.st_mtime)}"
     return blake2b(meta.encode(), digest_size=3).hexdigest()
 
@@ -23,6 +25,7 @@ def ffmpeg_video(orig: Path, target: Path):
     logger.info(f"Converting to a compatible format in cache {orig} → {target}")
     ffmpeg_command = [
         "ffmpeg",
+        "-nostdin",
         "-i",
         orig,
         "-c:v",
@@ -37,7 +40,6 @@ def ffmpeg_video(orig: Path, target: Path):
         "experimental",
         "-v",
         "warning",
-        "-stats",
         target,
     ]
     logger.debug("ffmpeg command: %s", shlex.join([str(c) for c in ffmpeg_command]))
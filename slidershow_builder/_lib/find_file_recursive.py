@@ -1,4 +1,5 @@
 import json
+import os
 from contextlib import contextmanager
 from pathlib import Path
 from typing import Optional
@@ -14,6 +15,7 @@ CACHE_FILE = Path.home() / ".cache" / "slidershow_builder" / "file_cache.json"
 CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
 
 cache: dict[str, str] = {}
+directory_indexes: dict[tuple[Path, ...], dict[str, Path]] = {}
 
 @contextmanager
 def filename_cache(enabled: bool):
@@ -24,11 +26,10 @@ def filename_cache(enabled: bool):
         with filename_cache(m.env.filename_autosearch_cache):
             ...
     """
-    global cache
     if enabled and CACHE_FILE.exists():
         try:
             with open(CACHE_FILE, "r") as f:
-                cache = json.load(f)
+                cache.update(json.load(f))
         except json.JSONDecodeError:
             pass
     try:
@@ -63,12 +64,24 @@ def find_file_recursive(name: str, directories: list[Path]) -> Optional[Path]:
             del cache[name]
 
     # Search directories recursively
-    for d in directories:
-        if not d.is_dir():
-            continue
-        for p in d.rglob(name):
-            if p.is_file():
-                cache[name] = str(p.absolute())
-                return p.absolute()
+    if p := _directory_index(directories).get(name):
+        cache[name] = str(p.absolute())
+        return p.absolute()
     return None
 
+
+def _directory_index(directories: list[Path]) -> dict[str, Path]:
+    """Map filenames to their first path within the directories.
+
+    The directories are walked just once, instead of globbing them for every missing file.
+    """
+    key = tuple(directories)
+    if key not in directory_indexes:
+        index: dict[str, Path] = {}
+        for d in directories:
+            for root, _, files in os.walk(d):
+                for fn in files:
+                    index.setdefault(fn, Path(root, fn))
+        directory_indexes[key] = index
+    return directory_indexes[key]
+
@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import lru_cache
 import logging
+from itertools import islice
 from pathlib import Path
-from re import match
+import re
+from typing import Sequence
 
+import ezodf
 from tqdm import tqdm
 
-from .find_file_recursive import find_file_recursive
-from .convert import IMAGE_SUFFIXES
+from .convert import IMAGE_SUFFIXES, Convert
+from .env import Env
+from .find_file_recursive import cache as autosearch_cache, find_file_recursive
 
 logger = logging.getLogger(__name__)
 
@@ -14,15 +21,35 @@ TEMPLATE = """<article data-video-points='[{points}]'><video controls="controls"
 TEMPLATE_IMG = (
     """<article data-step-points='{points}'><img data-src="{src}"/></article>"""
 )
+
+
+def _split_template(template: str) -> tuple[str, str, str]:
+    """Pre-split the media template so that frames are just concatenated. `pre{points}mid{src}post`"""
+    pre, rest = template.split("{points}")
+    mid, post = rest.split("{src}")
+    return pre, mid, post
+
+
+TEMPLATE_PARTS = _split_template(TEMPLATE)
+TEMPLATE_IMG_PARTS = _split_template(TEMPLATE_IMG)
 TEMPLATE_TEXT = """<article class="main">
                     <h1>{title}</h1>
                     <p>{text}</p>
                 </article>"""
+CONVERT_WORKERS = 2
+""" Number of media converted at once. (ffmpeg uses multiple cores by itself.) """
 TNUM = (
     r"(\d*(?::\d+)?\.?\d+?)"  # time number, a number including decimal dot and a colon
 )
 NUM = r"(\d*\.?\d+?)"  # a number including decimal dot, ex '3', '1.3', '.3'
 
+# either a lone moment, or a moment jump `5 → 10`
+_RE_TIME = re.compile(rf"(?P<moment>{TNUM}$)|(?P<range>{TNUM}\s?→\s?{TNUM})")
+_RE_GOTO = re.compile(rf"→\s?{TNUM}$")
+_RE_F = re.compile(rf"F{NUM}(M|U)?")
+_RE_R = re.compile(rf"R{NUM}(M|U)?")
+_RE_RATE = re.compile(rf"rate\s?{NUM}")
+
 clist = {
     "mute": "mute",
     "unmute": "unmute",
@@ -33,84 +60,116 @@ clist = {
 
 
 def output_tokens(moment, tokens):
-    return f'[{moment}, {",".join(f'"{t}"' for t in tokens)}]'
+    return "[" + str(moment) + ', "' + '","'.join(tokens) + '"]'
 
 
-def tim(v: str) -> int:
+def tim(v: str) -> str | float:
     """Convert number in format min:sec to total seconds. `1:32.2` → 92.2, `5` → 5"""
-    if not ":" in v:
+    i = v.find(":")
+    if i < 0:
         return v
-    minutes, seconds = map(float, v.split(":"))
-    total_seconds = minutes * 60 + seconds
-    return total_seconds
+    return float(v[:i]) * 60 + float(v[i + 1 :])
+
 
+def _classify(command: str) -> tuple | None:
+    """Tag the command as `(kind, *args)`, or None if unknown.
+
+    Dispatch on the first character so that a single pattern is tried per command.
+    """
+    c0 = command[:1]
+    if c0.isdigit() or c0 in (".", ":"):
+        if m := _RE_TIME.match(command):
+            if m.lastgroup == "moment":
+                return "moment", m[2]
+            return "range", m[4], m[5]
+    elif c0 == "→":
+        if m := _RE_GOTO.match(command):
+            return "tokens", f"goto:{tim(m[1])}"
+    elif c0 == "F":
+        if m := _RE_F.match(command):  # faster 1.N
+            rate = f"rate:1.{m[1]}"
+            return ("tokens", rate, clist[m[2]]) if m[2] else ("tokens", rate)
+    elif c0 == "R":
+        if m := _RE_R.match(command):
+            rate = f"rate:{m[1]}"
+            return ("tokens", rate, clist[m[2]]) if m[2] else ("tokens", rate)
+    elif c0 == "r":
+        if m := _RE_RATE.match(command):
+            return "tokens", f"rate:{m[1]}"
+    elif (token := clist.get(command)) is not None:
+        return "tokens", token
+    elif command.startswith("point"):
+        return "tokens", command
+    elif c0 == "P":  # as play
+        return "tokens", "rate:1", "unmute"
+    elif command.startswith("TODO"):
+        return ("todo",)
+    return None
+
+
+def _split_commands(commands: list[str | None]):
+    """Split the cells into single commands in a single pass."""
+    for cmd in commands:
+        if not cmd:  # filter out empty cells
+            continue
+        # Make pipe behave like the cell-barrier.
+        # `["→2", "5,→7|9,→11"]` -> `["→2", "5,→7", "9,→11"]`
+        for part in cmd.split("|"):
+            if not part:
+                continue
+            # `rate1,M` → `rate1` , `M`
+            # `point:[161.2,204.9,5]` stays the same
+            if "[" in part:
+                yield part.strip()
+            else:
+                for r in part.split(","):
+                    yield r.strip()
 
-def parse_commands(start: str | None, commands: list[str]):
+
+@lru_cache(maxsize=8192)
+def parse_commands_cached(
+    start: str | None, commands: tuple[str | None, ...]
+) -> tuple[str, ...]:
+    """The same command patterns tend to repeat across the rows, parse each just once."""
+    return tuple(parse_commands(start, commands))
+
+
+def parse_commands(start: str | None, commands: Sequence[str | None]):
     moment: str | float | int | None = None
     tokens = []
 
     if start and start != "0":
-        commands.insert(0, "0")
-        commands.insert(1, f"→{tim(start)}")
-
-    # Make pipe behave like the cell-barrier.
-    # `["→2", "5,→7|9,→11"]` -> `["→2", "5,→7", "9,→11"]`
-    commands = [part for cmd in commands for part in (cmd or "").split("|") if part]
-
-    # filter out trailing empty cells
-    # What does this do?
-    # `rate1,M` → `rate1` , `M`
-    # `point:[161.2,204.9,5]` stays the same
-    commands = [
-        r.strip()
-        for subcommand in commands
-        if subcommand is not None
-        for r in ([subcommand] if "[" in subcommand else subcommand.split(","))
-    ]
+        commands = ["0", f"→{tim(start)}", *commands]
+
+    commands = list(_split_commands(commands))
     logger.info(commands)
+    last_idx = len(commands) - 1
     for i, command in enumerate(commands):
-        if m := match(rf"{TNUM}$", command):
-            if moment or tokens:
-                if not tokens:
-                    raise ValueError(f"No action at {command} at: {commands}")
-                if not moment:
-                    moment = "0"
-                yield output_tokens(moment, tokens)
-
-            moment = tim(m[0])
-            tokens.clear()
-            if i == len(commands) - 1:  # end number, stop at this moment1
-                yield f'[{tim(m[0])}, "pause"]'
-            continue
-        elif m := match(rf"→\s?{TNUM}$", command):
-            tokens.append(f"goto:{tim(m[1])}")
-        elif m := match(rf"{TNUM}\s?→\s?{TNUM}", command):
-            if moment:
-                raise ValueError(
-                    f"Moment already defined, moment {moment} while processing {command} at {commands}"
-                )
-            yield f'[{tim(m[1])}, "goto:{tim(m[2])}"]'
-        elif m := match(rf"F{NUM}(M|U)?", command):  # faster 1.N
-            tokens.append(f"rate:1.{m[1]}")
-            if m.group(2):
-                tokens.append(clist[m[2]])
-        elif m := match(rf"R{NUM}(M|U)?", command):
-            tokens.append(f"rate:{m[1]}")
-            if m.group(2):
-                tokens.append(clist[m[2]])
-        elif m := match(rf"rate\s?{NUM}", command):
-            tokens.append(f"rate:{m[1]}")
-        elif command in clist:
-            tokens.append(clist[command])
-        elif command.startswith("point"):
-            tokens.append(command)
-        elif m := match(rf"P", command):  # as play
-            tokens.append(f"rate:1")
-            tokens.append("unmute")
-        elif command.startswith("TODO"):
-            logger.warning(command)  # undocumented feature
-        else:
-            raise ValueError(f"Unknown command {command} at {commands}")
+        match _classify(command):
+            case ("moment", value):
+                if moment or tokens:
+                    if not tokens:
+                        raise ValueError(f"No action at {command} at: {commands}")
+                    if not moment:
+                        moment = "0"
+                    yield output_tokens(moment, tokens)
+
+                moment = tim(value)
+                tokens.clear()
+                if i == last_idx:  # end number, stop at this moment1
+                    yield f'[{tim(value)}, "pause"]'
+            case ("range", frm, to):
+                if moment:
+                    raise ValueError(
+                        f"Moment already defined, moment {moment} while processing {command} at {commands}"
+                    )
+                yield f'[{tim(frm)}, "goto:{tim(to)}"]'
+            case ("tokens", *new_tokens):
+                tokens.extend(new_tokens)
+            case ("todo",):
+                logger.warning(command)  # undocumented feature
+            case _:
+                raise ValueError(f"Unknown command {command} at {commands}")
     if tokens:
         yield output_tokens(moment or "0", tokens)
 
@@ -123,88 +182,199 @@ def is_plain_filename(p: Path) -> bool:
 def cell_value(val):
     if val is None:
         return val
-    if isinstance(val, (int, float)):
-        return str(val).replace(".0", "")
+    if isinstance(val, float) and val.is_integer():
+        return str(int(val))  # `5.0` → `5`, whereas `1.05` stays
     return str(val)
 
-def process_sheet(m, suffix, sheet):
-    print(f"Processing: {m.env.file} / {sheet.name}")
+
+def media_frame(
+    convert: Convert, template_parts: tuple[str, str, str], points: str, path: Path
+) -> str:
+    pre, mid, post = template_parts
+    return f"{pre}{points}{mid}{convert.run(path)}{post}"
+
+
+_CONTENTS_SENTINEL = "\0contents\0"
+
+
+@lru_cache
+def page_template(template: Path, slidershow_url: str) -> tuple[str, ...]:
+    """Read the page template just once for all the sheets.
+
+    Return the parts around the `{contents}` placeholders (the contents go into each of them).
+    """
+    text = template.read_text().format(
+        contents=_CONTENTS_SENTINEL, slidershow_url=slidershow_url
+    )
+    return tuple(text.split(_CONTENTS_SENTINEL))
+
+
+def process_sheet(
+    env: Env,
+    suffix: bool,
+    sheet,
+    convert_workers: int = CONVERT_WORKERS,
+    progress: bool = True,
+):
+    print(f"Processing: {env.file} / {sheet.name}")
     output = []
-    for row in (pbar := tqdm(list(sheet.rows())[1:])):
-        comment, filename, start, *commands = [
-                cell_value(cell.value) for cell in row
-            ]
+    # (comment, html) to be emitted
+    frames: deque[tuple[str | None, str | Future[str]]] = deque()
+    converting: dict[Future[str], str] = {}  # media frame → file name
 
-        if comment == "SECTION":
-            output.append("</section><section>")
-            continue
-        if not any((comment, filename, start, *commands)):
-            print("EARLY STOP on empty row")
-            break
-
-        if filename:  # media frame
-                # parse commands
-            path = Path(filename)
-            pbar.set_postfix_str(path.name)
-            suff = path.suffix.lower()
-            if suff in IMAGE_SUFFIXES:
-                template = TEMPLATE_IMG
-                points = start or ""
-                if any(c.strip() for c in commands if c):
-                    logger.warning(
-                            f"commands are being ignored for img '{filename}' {commands}"
-                        )
+    def emit_frames(wait: bool):
+        """Emit the frames in the sheet order, as far as they are rendered (or wait for them)."""
+        while frames and (
+            wait or not isinstance(frames[0][1], Future) or frames[0][1].done()
+        ):
+            comment, out = frames.popleft()
+            if isinstance(out, Future):
+                out = out.result()
+            if env.output:
+                if comment:
+                    output.append(f"<!-- {comment} -->")
+                output.append(out)
             else:
-                template = TEMPLATE
-                try:
-                    points = ",".join(parse_commands(start, commands))
-                except ValueError as e:
-                    e.add_note(f"At filename: {filename}")
-                    raise
-
-                # change the name
-            if m.env.replace_in_filename:
-                for args in m.env.replace_in_filename:
-                    path = Path(filename.replace(*args))
-                    filename = str(path)
-
-            if (
-                    m.env.filename_autosearch
-                    and not path.exists()
-                    and is_plain_filename(path)
-                ):
-                if p := find_file_recursive(filename, m.env.filename_autosearch):
-                    path = p
-                    filename = str(path)
+                if comment:
+                    print(comment)
+                print(out)
+
+    # Stream the rows instead of materializing the whole sheet first,
+    # parsing usually ends early on the first empty row.
+    rows = islice(sheet.rows(), 1, None)  # skip the header
+    early_stop = False
+    # Without conversion, rendering the media frame is instant, no need for threads.
+    executor = (
+        ThreadPoolExecutor(max_workers=convert_workers) if env.convert.enable else None
+    )
+    try:
+        for row in (
+            pbar := tqdm(rows, total=max(sheet.nrows() - 1, 0), disable=not progress)
+        ):
+            values = []
+            nonempty = False
+            for cell in row:
+                value = cell_value(cell.value)
+                values.append(value)
+                if value:
+                    nonempty = True
+            comment, filename, start, *commands = values
+
+            if comment == "SECTION":
+                if env.output:
+                    frames.append((None, "</section><section>"))
+                continue
+            if not nonempty:
+                early_stop = True
+                break
+
+            if filename:  # media frame
+                    # parse commands
+                path = Path(filename)
+                pbar.set_postfix_str(path.name)
+                suff = path.suffix.lower()
+                if suff in IMAGE_SUFFIXES:
+                    template_parts = TEMPLATE_IMG_PARTS
+                    points = start or ""
+                    if any(c.strip() for c in commands if c):
+                        logger.warning(
+                                f"commands are being ignored for img '{filename}' {commands}"
+                            )
                 else:
-                    logger.warning("Filename %s does not exist", filename)
-
-                # convert to cache
-            filename_used = m.env.convert.run(path)
-
-            out = template.format(points=points, src=filename_used)
-        elif start or commands:  # text frame
-            out = TEMPLATE_TEXT.format(
-                    title=start, text="".join(str(a) for a in commands if a)
-                )
-        else:
-            raise ValueError
-
-        if m.env.output:
-            if comment:
-                output.append(f"<!-- {comment} -->")
-            output.append(out)
-        else:
-            if comment:
-                print(comment)
-            print(out)
-
-    if fname := m.env.output:
+                    template_parts = TEMPLATE_PARTS
+                    try:
+                        points = ",".join(parse_commands_cached(start, tuple(commands)))
+                    except ValueError as e:
+                        e.add_note(f"At filename: {filename}")
+                        raise
+
+                    # change the name
+                if env.replace_in_filename:
+                    for args in env.replace_in_filename:
+                        path = Path(filename.replace(*args))
+                        filename = str(path)
+
+                if (
+                        env.filename_autosearch
+                        and not path.exists()
+                        and is_plain_filename(path)
+                    ):
+                    if p := find_file_recursive(filename, env.filename_autosearch):
+                        path = p
+                        filename = str(path)
+                    else:
+                        logger.warning("Filename %s does not exist", filename)
+
+                    # convert to cache, possibly slow, let it run while parsing further rows
+                if executor:
+                    out = executor.submit(
+                        media_frame, env.convert, template_parts, points, path
+                    )
+                    converting[out] = path.name
+                else:
+                    out = media_frame(env.convert, template_parts, points, path)
+            elif start or commands:  # text frame
+                out = TEMPLATE_TEXT.format(
+                        title=start, text="".join(filter(None, commands))
+                    )
+            else:
+                raise ValueError
+            frames.append((comment, out))
+            emit_frames(wait=False)
+
+        if converting:
+            cbar = tqdm(
+                as_completed(converting),
+                total=len(converting),
+                desc="Converting",
+                disable=not progress,
+            )
+            for future in cbar:
+                cbar.set_postfix_str(converting[future])
+        emit_frames(wait=True)
+    finally:
+        if executor:
+            # do not start the queued conversions on an error or Ctrl+C
+            executor.shutdown(cancel_futures=True)
+
+    if early_stop:
+        print("EARLY STOP on empty row")
+
+    if fname := env.output:
         if suffix:
             fname = fname.with_name(f"{fname.stem}_{sheet.name}{fname.suffix}")
-        fname.write_text(
-                m.env.slidershow.template.read_text().format(
-                    contents="\n".join(output), slidershow_url=m.env.slidershow.url
-                )
-            )
-        print("Written to", fname)
\ No newline at end of file
+        # Stream the contents into the template instead of building the whole page in memory.
+        first, *rest = page_template(env.slidershow.template, env.slidershow.url)
+        with fname.open("w", buffering=1 << 20) as f:
+            f.write(first)
+            for part in rest:
+                for i, line in enumerate(output):
+                    if i:
+                        f.write("\n")
+                    f.write(line)
+                f.write(part)
+        print("Written to", fname)
+
+
+def process_sheet_by_name(
+    env: Env, suffix: bool, sheet_name: str, known_files: dict[str, str]
+) -> tuple[dict[str, str], set[str]]:
+    """Process the sheet in a worker process.
+
+    ezodf sheets cannot be pickled, hence the document is opened again here.
+    The filename autosearch cache is passed in. Return the entries the worker added
+    and the stale entries it removed, so that the main process can persist them.
+    """
+    autosearch_cache.clear()
+    autosearch_cache.update(known_files)
+    # The sheets are converting in parallel already, keep the total of conversions bounded.
+    # Progress bars of the parallel workers would garble the terminal.
+    process_sheet(
+        env,
+        suffix,
+        ezodf.opendoc(env.file).sheets[sheet_name],
+        convert_workers=1,
+        progress=False,
+    )
+    added = {k: v for k, v in autosearch_cache.items() if known_files.get(k) != v}
+    return added, known_files.keys() - autosearch_cache.keys()